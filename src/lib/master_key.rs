@@ -8,8 +8,11 @@ pub struct MasterKey {
 
 impl MasterKey {
     #![allow(dead_code)]
-    pub fn raw_key(&self) -> Vec<u8>{
+    pub fn raw_key(&self) -> [u8; 64] {
         // Combine the AES and MAC keys into a single key through copying
-        [self.aes_master_key, self.mac_master_key].concat()
+        let mut raw_key = [0u8; 64];
+        raw_key[..32].copy_from_slice(&self.aes_master_key);
+        raw_key[32..].copy_from_slice(&self.mac_master_key);
+        raw_key
     }
 }
@@ -1,10 +1,16 @@
 #![forbid(unsafe_code)]
 
+use std::borrow::Cow;
+
+use aes::cipher::KeyInit;
+use aes::Aes256;
+use generic_array::GenericArray;
 use ring::hmac;
 use serde::{Deserialize, Serialize};
 use serde_with::base64::Base64;
 use serde_with::serde_as;
-use unicode_normalization::UnicodeNormalization;
+use thiserror::Error;
+use unicode_normalization::{is_nfc_quick, IsNormalized, UnicodeNormalization};
 
 use super::master_key::MasterKey;
 use super::rfc_3394;
@@ -31,23 +37,43 @@ pub struct MasterKeyFile {
     pub version_mac: Vec<u8>,
 }
 
+#[derive(Error, Debug)]
+pub enum UnlockError {
+    #[error("The scrypt parameters are invalid.")]
+    InvalidScryptParameters,
+    #[error("Failed to unwrap the AES key: {0}")]
+    AesKeyUnwrap(#[source] rfc_3394::UnwrapError),
+    #[error("Failed to unwrap the MAC key: {0}")]
+    MacKeyUnwrap(#[source] rfc_3394::UnwrapError),
+    #[error("The unwrapped key is not 256 bits long.")]
+    InvalidKeyLength,
+    #[error("The vault version HMAC check failed.")]
+    InvalidVersionMac,
+}
+
 impl MasterKeyFile {
-    pub fn derive_key(&self, passphrase: &str) -> [u8; 32] {
-        // We use NFC normalization on the passphrase
-        let normalized_passphrase = passphrase.nfc().collect::<String>();
+    pub fn derive_key(&self, passphrase: &str) -> Result<[u8; 32], UnlockError> {
+        // We use NFC normalization on the passphrase, only allocating
+        // a normalized copy if the quick check can't confirm it's already NFC
+        let normalized_passphrase: Cow<str> = match is_nfc_quick(passphrase.chars()) {
+            IsNormalized::Yes => Cow::Borrowed(passphrase),
+            _ => Cow::Owned(passphrase.nfc().collect()),
+        };
 
         // Define the scrypt parameters
-        let log2_n: u8 = log_2(self.scrypt_cost_param) as u8;
+        let log2_n: u8 =
+            log_2(self.scrypt_cost_param).ok_or(UnlockError::InvalidScryptParameters)? as u8;
         let r: u32 = self.scrypt_block_size as u32;
         let p: u32 = 1;
 
         let scrypt_params =
-            scrypt::Params::new(log2_n, r, p).expect("Failed to create scrypt parameters");
+            scrypt::Params::new(log2_n, r, p).map_err(|_| UnlockError::InvalidScryptParameters)?;
 
         // Initialize kek to 256-bit empty array
         let mut kek = [0u8; 32];
 
         // Derive the kek from the normalized passphrase
+        // (this can only fail on an invalid output length, and ours is fixed)
         scrypt::scrypt(
             normalized_passphrase.as_bytes(),
             &self.scrypt_salt,
@@ -56,47 +82,159 @@ impl MasterKeyFile {
         )
         .expect("Failed to derive kek");
 
-        kek
+        Ok(kek)
     }
 
-    pub fn unlock(&self, passphrase: &str) -> MasterKey {
-        let kek = self.derive_key(&passphrase);
+    /// Unlocks the master key with the given passphrase.
+    ///
+    /// In the case that the passphrase is not the correct one,
+    /// it is expected that unwrapping the AES key will fail (`AesKeyUnwrap`).
+    pub fn unlock(&self, passphrase: &str) -> Result<MasterKey, UnlockError> {
+        let kek = self.derive_key(passphrase)?;
         self.unlock_with_kek(&kek)
     }
 
-    fn unlock_with_kek(&self, kek: &[u8; 32]) -> MasterKey {
+    fn unlock_with_kek(&self, kek: &[u8; 32]) -> Result<MasterKey, UnlockError> {
+        // Expand the kek once, as both keys are wrapped with it
+        let cipher = Aes256::new(GenericArray::from_slice(kek));
+
         // Unwrap the primary master key
-        let aes_key = rfc_3394::unwrap_key(&self.primary_master_key, &kek)
-            .expect("Failed to unwrap AES key.");
-        let aes_key: [u8; 32] = aes_key.try_into().unwrap();
+        let aes_key = rfc_3394::unwrap_key_with_cipher(&self.primary_master_key, &cipher)
+            .map_err(UnlockError::AesKeyUnwrap)?;
+        let aes_key: [u8; 32] = aes_key
+            .try_into()
+            .map_err(|_| UnlockError::InvalidKeyLength)?;
         // Unwrap the Hmac key
-        let hmac_key = rfc_3394::unwrap_key(&self.hmac_master_key, &kek).unwrap();
-        let hmac_key: [u8; 32] = hmac_key.try_into().expect("Failed to unwrap HMAC key.");
+        let hmac_key = rfc_3394::unwrap_key_with_cipher(&self.hmac_master_key, &cipher)
+            .map_err(UnlockError::MacKeyUnwrap)?;
+        let hmac_key: [u8; 32] = hmac_key
+            .try_into()
+            .map_err(|_| UnlockError::InvalidKeyLength)?;
 
         // Cross-reference versions
-        self.check_vault_version(&hmac_key);
+        self.check_vault_version(&hmac_key)?;
 
         // Construct key
-        MasterKey {
+        Ok(MasterKey {
             aes_master_key: aes_key,
             mac_master_key: hmac_key,
-        }
+        })
     }
 
-    fn check_vault_version(&self, mac_key: &[u8]) {
+    fn check_vault_version(&self, mac_key: &[u8]) -> Result<(), UnlockError> {
         let key = hmac::Key::new(hmac::HMAC_SHA256, mac_key);
 
         hmac::verify(&key, &self.version.to_be_bytes(), &self.version_mac)
-            .expect("HMAC check failed");
+            .map_err(|_| UnlockError::InvalidVersionMac)
     }
 }
 
-// From: https://users.rust-lang.org/t/logarithm-of-integers/8506/5
-const fn num_bits<T>() -> usize {
-    std::mem::size_of::<T>() * 8
+fn log_2(x: i32) -> Option<u32> {
+    // Scrypt's cost parameter (N) must be a power of two greater than 1 (RFC 7914),
+    // otherwise it would be silently rounded down to a different cost.
+    // The exponent of a power of two is its number of trailing zeros
+    (x > 1 && (x as u32).is_power_of_two()).then(|| x.trailing_zeros())
 }
 
-fn log_2(x: i32) -> u32 {
-    assert!(x > 0);
-    num_bits::<i32>() as u32 - x.leading_zeros() - 1
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use hex_literal::hex;
+
+    const KEK: [u8; 32] = [0x11; 32];
+    const AES_KEY: [u8; 32] = [0x22; 32];
+    const MAC_KEY: [u8; 32] = [0x33; 32];
+    const VERSION: u32 = 999;
+
+    fn master_key_file(version_mac: Vec<u8>) -> MasterKeyFile {
+        MasterKeyFile {
+            version: VERSION,
+            scrypt_salt: vec![0; 8],
+            scrypt_cost_param: 32768,
+            scrypt_block_size: 8,
+            primary_master_key: rfc_3394::wrap_key(&AES_KEY, &KEK).unwrap(),
+            hmac_master_key: rfc_3394::wrap_key(&MAC_KEY, &KEK).unwrap(),
+            version_mac,
+        }
+    }
+
+    fn version_mac() -> Vec<u8> {
+        let key = hmac::Key::new(hmac::HMAC_SHA256, &MAC_KEY);
+        hmac::sign(&key, &VERSION.to_be_bytes()).as_ref().to_vec()
+    }
+
+    #[test]
+    fn test_unlock_with_kek() {
+        let master_key = master_key_file(version_mac())
+            .unlock_with_kek(&KEK)
+            .unwrap();
+        assert_eq!(master_key.aes_master_key, AES_KEY);
+        assert_eq!(master_key.mac_master_key, MAC_KEY);
+    }
+
+    #[test]
+    fn test_unlock_with_wrong_kek() {
+        let result = master_key_file(version_mac()).unlock_with_kek(&[0x44; 32]);
+        assert!(matches!(result, Err(UnlockError::AesKeyUnwrap(_))));
+    }
+
+    #[test]
+    fn test_unlock_with_empty_primary_master_key() {
+        let mut file = master_key_file(version_mac());
+        file.primary_master_key = vec![];
+        let result = file.unlock_with_kek(&KEK);
+        assert!(matches!(result, Err(UnlockError::AesKeyUnwrap(_))));
+    }
+
+    #[test]
+    fn test_unlock_with_invalid_version_mac() {
+        let result = master_key_file(vec![0; 32]).unlock_with_kek(&KEK);
+        assert!(matches!(result, Err(UnlockError::InvalidVersionMac)));
+    }
+
+    #[test]
+    fn test_unlock_with_invalid_scrypt_cost_param() {
+        let mut file = master_key_file(version_mac());
+        for cost_param in [30000, 1, 0, -32768] {
+            file.scrypt_cost_param = cost_param;
+            let result = file.unlock("passphrase");
+            assert!(matches!(result, Err(UnlockError::InvalidScryptParameters)));
+        }
+    }
+
+    #[test]
+    fn test_derive_key_with_ascii_passphrase() {
+        let mut file = master_key_file(version_mac());
+        file.scrypt_cost_param = 16;
+
+        // ASCII is already NFC, so the passphrase bytes are used as-is
+        let kek = hex!("A1A79E4F285BFBDFCB3873B3A71E9B709137CCB44C79C30F59C8C50469BB8185");
+        assert_eq!(file.derive_key("passphrase").unwrap(), kek);
+    }
+
+    #[test]
+    fn test_derive_key_normalizes_passphrase() {
+        let mut file = master_key_file(version_mac());
+        file.scrypt_cost_param = 16;
+
+        // Both the decomposed and the precomposed "é" derive from its NFC form
+        let kek = hex!("DC7F9A07E7DB73B2F264A3DB606D708A70951C0CEFF3347C93BC5EA79388C135");
+        assert_eq!(file.derive_key("e\u{301}").unwrap(), kek);
+        assert_eq!(file.derive_key("\u{e9}").unwrap(), kek);
+    }
+
+    #[test]
+    fn test_log_2_of_powers_of_two() {
+        assert_eq!(log_2(2), Some(1));
+        assert_eq!(log_2(32768), Some(15));
+        assert_eq!(log_2(1 << 30), Some(30));
+    }
+
+    #[test]
+    fn test_log_2_rejects_non_power_of_two() {
+        assert_eq!(log_2(30000), None);
+        assert_eq!(log_2(1), None);
+        assert_eq!(log_2(0), None);
+        assert_eq!(log_2(-2), None);
+    }
 }
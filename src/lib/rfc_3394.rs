@@ -12,19 +12,12 @@
 
 use aes::cipher::{BlockEncrypt, KeyInit, BlockDecrypt};
 use aes::Aes256;
-use zeroize::Zeroize;
 use thiserror::Error;
 
 // We should eventually ditch generic arrays and start using const generics.
-use generic_array::{
-    sequence::Concat,
-    typenum::{U16, U32, U8},
-    GenericArray,
-};
+use generic_array::{typenum::U16, GenericArray};
 
-type U8x8 = GenericArray<u8, U8>;
 type Block = GenericArray<u8, U16>;
-type KeyData = GenericArray<u8, U32>;
 
 extern crate hex;
 extern crate test;
@@ -35,9 +28,16 @@ extern crate test;
 */
 const IV_3394: [u8; 8] = [0xa6, 0xa6, 0xa6, 0xa6, 0xa6, 0xa6, 0xa6, 0xa6];
 
+/// XORs the integrity check register (A), stored in the first 64 bits of
+/// the block, with the step counter t as a single big-endian 64-bit word.
+fn xor_integrity_check(block: &mut Block, t: u64) {
+    let a = u64::from_be_bytes(block[0..8].try_into().unwrap()) ^ t;
+    block[0..8].copy_from_slice(&a.to_be_bytes());
+}
+
 #[derive(Error, Debug)]
 pub enum WrapError {
-    #[error("The plaintext length is not a multiple of 64 bits per RFC3394.")]
+    #[error("The plaintext is empty or its length is not a multiple of 64 bits per RFC3394.")]
     InvalidPlaintextLength,
 }
 
@@ -47,65 +47,60 @@ pub enum WrapError {
 /// For now this function only supports AES-256.
 pub fn wrap_key(plaintext: &[u8], kek: &[u8; 32]) -> Result<Vec<u8>, WrapError> {
 
-    // Ensure that the plaintext is a multiple of 64 bits
-    if plaintext.len() % 8 != 0 {
+    // Ensure that the plaintext is a non-empty multiple of 64 bits,
+    // so the output can always be unwrapped again
+    if plaintext.is_empty() || plaintext.len() % 8 != 0 {
         return Err(WrapError::InvalidPlaintextLength);
     }
 
-    // Acquire ownership through copying
-    let plaintext = plaintext.to_owned();
-    let mut kek = KeyData::from(kek.to_owned());
+    // Acquire ownership through copying, straight into the output buffer
+    // so that the registers don't need to be moved again at the end
+    let mut ciphertext = Vec::with_capacity(plaintext.len() + 8);
+    ciphertext.extend_from_slice(&IV_3394);
+    ciphertext.extend_from_slice(plaintext);
 
     // 1) Initialize variables
     let n_blocks = plaintext.len() / 8;
-    // The 64-bit integrity check register (A)
-    let mut integrity_check: U8x8 = U8x8::from(IV_3394);
-    // An array of 64-bit registers of length n (R)
-    let mut registers = plaintext;
+    // A single working block (B) reused across all steps, whose first
+    // 64 bits always hold the integrity check register (A)
+    let mut block = Block::default();
+    block[0..8].copy_from_slice(&IV_3394);
+    // An array of 64-bit registers of length n (R), stored after A in the output
+    let registers = &mut ciphertext[8..];
 
     // 2) Calculate intermediate values
-    let cipher = Aes256::new(&kek);
+    let cipher = Aes256::new(GenericArray::from_slice(kek));
 
     // Wrap the key in 6 * n_blocks steps
     for j in 0..6 {
         for (i, chunk) in registers.chunks_mut(8).enumerate() {
             // i was supposed to start from 1, so we shift
-            let t = (n_blocks * j) + (i + 1);
-            let plaintext_block: U8x8 = *U8x8::from_slice(chunk);
+            let t = ((n_blocks * j) + (i + 1)) as u64;
 
             // B = AES(K, A | R[i])
-            let mut iv_block: Block = integrity_check.concat(plaintext_block);
-            cipher.encrypt_block(&mut iv_block);
+            block[8..16].copy_from_slice(chunk);
+            cipher.encrypt_block(&mut block);
 
             // A = MSB(64, B) ^ t where t = (n*j)+i
-            // Because we're using BE, we can just get the first 64 bits
-            let a = &mut iv_block[0..8];
-
-            // XOR with t
-            for i in 0..8 {
-                a[i] ^= t.to_be_bytes()[i];
-            }
-            // Overwrite integrity_check with a
-            integrity_check.copy_from_slice(a);
+            // Because we're using BE, A is already in the first 64 bits
+            xor_integrity_check(&mut block, t);
 
             // R[i] = LSB(64xw, B)
-            chunk.copy_from_slice(&iv_block[8..16]);
+            chunk.copy_from_slice(&block[8..16]);
         }
     }
 
     // 3) Output the results
-    let mut ciphertext = integrity_check.to_vec();
-    ciphertext.extend(registers);
-
-    // Zero out the kek buffer
-    kek.zeroize();
+    // The registers are already in place, so we only need to write
+    // the final A into the slot reserved at the front
+    ciphertext[0..8].copy_from_slice(&block[0..8]);
 
     Ok(ciphertext)
 }
 
 #[derive(Error, Debug)]
 pub enum UnwrapError {
-    #[error("The ciphertext length is not a multiple of 64 bits per RFC3394.")]
+    #[error("The ciphertext length is under 128 bits or not a multiple of 64 bits per RFC3394.")]
     InvalidCiphertextLength,
     #[error("The integrity check failed.")]
     InvalidIntegrityCheck,
@@ -118,56 +113,55 @@ pub enum UnwrapError {
 /// In the case that the given kek is not the correct key,
 /// it is expected that the integrity check will fail (`InvalidIntegrityCheck`).
 pub fn unwrap_key(ciphertext: &[u8], kek: &[u8; 32]) -> Result<Vec<u8>, UnwrapError> {
-    // Ensure that the ciphertext is a multiple of 64 bits
-    if ciphertext.len() % 8 != 0 {
+    let cipher = Aes256::new(GenericArray::from_slice(kek));
+
+    unwrap_key_with_cipher(ciphertext, &cipher)
+}
+
+/// Unwraps a key like [`unwrap_key`], but using an already initialized cipher.
+/// Callers unwrapping several keys with the same KEK can use this to
+/// expand the AES key schedule only once.
+pub fn unwrap_key_with_cipher(ciphertext: &[u8], cipher: &Aes256) -> Result<Vec<u8>, UnwrapError> {
+    // Ensure that the ciphertext is a multiple of 64 bits, and that it holds
+    // at least the IV block and one register so the arithmetic below can't underflow
+    if ciphertext.len() < 16 || ciphertext.len() % 8 != 0 {
         return Err(UnwrapError::InvalidCiphertextLength);
     }
 
-    // Acquire ownership through copying
-    let mut kek = KeyData::from(kek.to_owned());
-
     // 1) Initialize variables
     // We need to substract the IV block
     let n_blocks = (ciphertext.len() / 8) - 1;
-    // The 64-bit integrity check register (A) initialized from the first 8 bytes of ciphertext
-    let mut integrity_check = U8x8::from_slice(&ciphertext[0..8]).to_owned();
+    // A single working block (B) reused across all steps, whose first 64 bits
+    // hold the integrity check register (A), initialized from the first 8 bytes of ciphertext
+    let mut block = Block::default();
+    block[0..8].copy_from_slice(&ciphertext[0..8]);
     // An array of 64-bit registers of length n (R) initialized from the rest of the ciphertext
     let mut registers = ciphertext[8..].to_owned();
 
     // 2) Calculate intermediate values
-    let cipher = Aes256::new(&kek);
-
     // Unwrap the key in 6 * n_blocks steps
     for j in (0..6).rev() {
         for (i, chunk) in registers.chunks_mut(8).enumerate().rev() {
             // i was supposed to start from 1, so we shift
-            let t = (n_blocks * j) + (i + 1);
-            let ciphertext_block: U8x8 = *U8x8::from_slice(chunk);
+            let t = ((n_blocks * j) + (i + 1)) as u64;
 
             // B = AES-1(K, (A ^ t) | R[i]) where t = n*j+i
-            let a = &mut integrity_check.clone();
-            for i in 0..8 {
-                a[i] ^= t.to_be_bytes()[i];
-            }
-            let mut iv_block: Block = a.concat(ciphertext_block);
-            cipher.decrypt_block(&mut iv_block);
+            xor_integrity_check(&mut block, t);
+            block[8..16].copy_from_slice(chunk);
+            cipher.decrypt_block(&mut block);
 
             // A = MSB(64, B)
-            // Because we're using BE, we can just get the first 64 bits
-            integrity_check.copy_from_slice(&iv_block[0..8]);
+            // Because we're using BE, A is already in the first 64 bits
 
             // R[i] = LSB(64, B)
-            chunk.copy_from_slice(&iv_block[8..16]);
+            chunk.copy_from_slice(&block[8..16]);
         }
     }
 
     // 3) Output the results
 
-    // Zero out the kek buffer
-    kek.zeroize();
-
     // Check if the integrity check register matches the IV
-    if !integrity_check.eq(&U8x8::from(IV_3394)) {
+    if block[0..8] != IV_3394 {
         return Err(UnwrapError::InvalidIntegrityCheck);
     }
 
@@ -195,6 +189,15 @@ mod tests {
         wrap_key(&key_data, &kek).unwrap();
     }
 
+    #[test]
+    #[should_panic(expected = "InvalidPlaintextLength")]
+    fn test_wrap_empty_key_with_256_kek() {
+        let kek = hex!("000102030405060708090A0B0C0D0E0F101112131415161718191A1B1C1D1E1F");
+
+        // Wrap
+        wrap_key(&[], &kek).unwrap();
+    }
+
     #[test]
     fn test_wrap_128_key_with_256_kek() {
         let kek = hex!("000102030405060708090A0B0C0D0E0F101112131415161718191A1B1C1D1E1F");
@@ -240,6 +243,15 @@ mod tests {
         assert_eq!(&key_data, &unwrapped_key.as_slice());
     }
 
+    #[test]
+    #[should_panic(expected = "InvalidCiphertextLength")]
+    fn test_unwrap_empty_key_with_256_kek() {
+        let kek = hex!("000102030405060708090A0B0C0D0E0F101112131415161718191A1B1C1D1E1F");
+
+        // Unwrap
+        unwrap_key(&[], &kek).unwrap();
+    }
+
     #[test]
     #[should_panic(expected = "InvalidIntegrityCheck")]
     fn test_unwrap_192_key_with_wrong_kek() {
@@ -284,6 +296,21 @@ mod tests {
         assert_eq!(&key_data, &unwrapped_key.as_slice());
     }
 
+    #[test]
+    fn test_unwrap_keys_with_shared_cipher() {
+        let kek = hex!("000102030405060708090A0B0C0D0E0F101112131415161718191A1B1C1D1E1F");
+        let key_data_192 = hex!("00112233445566778899AABBCCDDEEFF0001020304050607");
+        let ciphertext_192 = hex!("A8F9BC1612C68B3F F6E6F4FBE30E71E4 769C8B80A32CB895 8CD5D17D6B254DA1");
+        let key_data_256 = hex!("00112233445566778899AABBCCDDEEFF000102030405060708090A0B0C0D0E0F");
+        let ciphertext_256 = hex!("28C9F404C4B810F4 CBCCB35CFB87F826 3F5786E2D80ED326 CBC7F0E71A99F43B FB988B9B7A02DD21");
+
+        let cipher = Aes256::new(GenericArray::from_slice(&kek));
+        let unwrapped_192 = unwrap_key_with_cipher(&ciphertext_192, &cipher).unwrap();
+        let unwrapped_256 = unwrap_key_with_cipher(&ciphertext_256, &cipher).unwrap();
+        assert_eq!(&key_data_192, &unwrapped_192.as_slice());
+        assert_eq!(&key_data_256, &unwrapped_256.as_slice());
+    }
+
     #[bench]
     fn bench_wrap_256_key_with_256_kek(b: &mut Bencher) {
         let kek = hex!("000102030405060708090A0B0C0D0E0F101112131415161718191A1B1C1D1E1F");
@@ -2,8 +2,10 @@
 #![feature(test)]
 
 use serde::{Deserialize, Serialize};
+use std::env::{self, VarError};
 use std::fs;
 use std::path::Path;
+use std::process;
 use url::Url;
 
 mod lib;
@@ -19,9 +21,46 @@ struct VaultConfigurationClaims {
     cipher_combo: String,
 }
 
+// Defaults matching the local test vault
+const DEFAULT_VAULT_PATH: &str = "vault";
+const DEFAULT_PASSPHRASE: &str = "123456789";
+// The passphrase is read from the environment rather than the command line,
+// where it would be visible to other users through the process list
+const PASSPHRASE_ENV_VAR: &str = "OXIDIZED_CRYPTOLIB_PASSPHRASE";
+
+fn usage(program: &str) -> String {
+    format!(
+        "Usage: {} [VAULT_PATH]\n\n\
+         The passphrase is read from the {} environment variable.\n\
+         If it is unset, the test vault passphrase \"{}\" is used.",
+        program, PASSPHRASE_ENV_VAR, DEFAULT_PASSPHRASE
+    )
+}
+
 fn main() {
+    let args: Vec<String> = env::args().collect();
+    match args.get(1).map(String::as_str) {
+        Some("-h" | "--help") => {
+            println!("{}", usage(&args[0]));
+            process::exit(0);
+        }
+        Some(arg) if arg.starts_with('-') || args.len() > 2 => {
+            eprintln!("{}", usage(&args[0]));
+            process::exit(2);
+        }
+        _ => {}
+    }
     // Path to the vault
-    let vault_path = Path::new("vault");
+    let vault_path = Path::new(args.get(1).map_or(DEFAULT_VAULT_PATH, String::as_str));
+    // Passphrase used to unlock the vault
+    let passphrase = match env::var(PASSPHRASE_ENV_VAR) {
+        Ok(passphrase) => passphrase,
+        Err(VarError::NotPresent) => DEFAULT_PASSPHRASE.to_string(),
+        Err(VarError::NotUnicode(_)) => {
+            eprintln!("{} is not valid Unicode.", PASSPHRASE_ENV_VAR);
+            process::exit(2);
+        }
+    };
     // Path to the vault's configuration file (vault.cryptomator)
     let vault_config_path = vault_path.join("vault.cryptomator");
 
@@ -36,13 +75,17 @@ fn main() {
     assert_eq!(masterkey_uri.scheme(), "masterkeyfile");
     let master_key_path = vault_path.join(Path::new(masterkey_uri.path()));
     // Read the master key configuration JSON from the masterkey path
-    let master_key_data_json = fs::read_to_string(&master_key_path).unwrap();
+    // (as raw bytes, serde_json validates UTF-8 only where it needs to)
+    let master_key_data_json = fs::read(&master_key_path).unwrap();
     // Decode the master key configuration JSON to a struct
-    let master_key_data: MasterKeyFile = serde_json::from_str(&master_key_data_json).unwrap();
+    let master_key_data: MasterKeyFile = serde_json::from_slice(&master_key_data_json).unwrap();
     // Unwrap the AES and MAC keys from the master key
-    let master_key = master_key_data.unlock("123456789");
-    dbg!(&master_key);
-    // Generate raw key
-    let raw_key = master_key.raw_key();
-    dbg!(&raw_key);
+    // (the keys themselves are never printed, as this may be a real vault)
+    match master_key_data.unlock(&passphrase) {
+        Ok(_) => println!("Unlocked the vault at {}", vault_path.display()),
+        Err(err) => {
+            eprintln!("Failed to unlock the vault: {}", err);
+            process::exit(1);
+        }
+    }
 }